@@ -6,6 +6,8 @@ from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from tenants import TenantSession, init_tenancy
+
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -14,7 +16,7 @@ class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": TenantSession})
 # Create the app
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "allergyextractsmanagementsecret")
@@ -31,9 +33,13 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 # Initialize the app with the extension
 db.init_app(app)
 
+# Multi-tenant mode: one database (or schema) per clinic, see tenants.py
+init_tenancy(app, db)
+
 with app.app_context():
     # Import the models
     import models  # noqa: F401
     
-    # Create all tables
-    db.create_all()
+    # Create all tables (tenant databases are created with `flask tenants create`)
+    if not app.config["TENANT_DATABASE_URL"]:
+        db.create_all()
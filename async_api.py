@@ -0,0 +1,482 @@
+"""
+Async read-only API for polling clients (wall displays, lab integrations).
+
+Runs on an ASGI server next to the Flask app and shares models.py:
+
+    uvicorn async_api:asgi_app --host 0.0.0.0 --port 5001
+
+Every endpoint is read-only; writes keep going through the Flask views, which
+record a ChangeEvent that /api/events pushes to the connected clients.
+
+The Replit deployment runs only gunicorn. Deploy this module as a second
+deployment (Reserved VM: SSE connections are long-lived) with the same
+DATABASE_URL/TENANT_* settings and the uvicorn command above; in tenant mode
+run `flask tenants migrate` after upgrading so every clinic has change_event.
+"""
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import selectinload
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from app import app, db
+from models import Panel, InventoryExtract, ChangeEvent
+from utils import counter_statements
+from email_utils import expiring_extracts_statement, MAX_DAYS_THRESHOLD
+from tenants import tenant_from
+
+
+logger = logging.getLogger(__name__)
+
+# Async drivers for the sync URLs used by the Flask app
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+EVENTS_POLL_INTERVAL = float(os.environ.get("EVENTS_POLL_INTERVAL", 2))
+EVENTS_KEEPALIVE = 15
+# Ids below the newest one seen that may still be committed late (Postgres
+# assigns ids at insert time, not at commit time)
+EVENTS_REORDER_WINDOW = 50
+# Maximum number of events sent again to a client that reconnects
+EVENTS_REPLAY_LIMIT = 500
+# Events queued for a client that reads slower than they arrive
+EVENTS_QUEUE_SIZE = 100
+
+
+def to_async_url(url):
+    """
+    Swap the driver of a sync database URL for its async counterpart
+
+    Returns:
+        tuple: The async URL and the connect_args it needs
+    """
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"Nessun driver asincrono configurato per il database {backend}")
+
+    connect_args = {}
+    if backend == 'postgresql':
+        # asyncpg rejects the libpq-only parameters found in Replit/Neon URLs
+        query = dict(url.query)
+        sslmode = query.pop('sslmode', None)
+        if sslmode:
+            connect_args['ssl'] = sslmode
+        query.pop('channel_binding', None)
+        url = url.set(query=query)
+    return url.set(drivername=ASYNC_DRIVERS[backend]), connect_args
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {json.dumps(event)}\n\n"
+
+
+def format_reset(last_id):
+    # The client must reload its state; it reconnects from last_id
+    return f"id: {last_id}\nevent: reset\ndata: {{}}\n\n"
+
+
+class Subscription:
+    """Queue of the events of one SSE client"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        # Set when the client fell behind and events were not queued
+        self.overflowed = False
+
+
+class ChangeBroadcaster:
+    """
+    Fan out ChangeEvent rows to the connected SSE clients.
+
+    A single task polls the database for new events, however many clients are
+    connected; it starts with the first subscriber and stops with the last one.
+    Delivery is at-least-once: a client may see an event twice after a
+    reconnect, and gets a ``reset`` event whenever events could not be delivered.
+    """
+
+    def __init__(self, sessionmaker):
+        self.sessionmaker = sessionmaker
+        self.subscribers = set()
+        # Newest event id read from the database, None until the task is ready
+        self.last_id = None
+        self._ready = asyncio.Event()
+        self._task = None
+
+    def subscribe(self):
+        subscription = Subscription()
+        self.subscribers.add(subscription)
+        if self._task is None:
+            self.last_id = None
+            self._ready = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+            self._task.add_done_callback(self._task_done)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+        if not self.subscribers:
+            self.close()
+
+    def close(self):
+        """Stop polling the database"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _task_done(self, task):
+        # Lets the next subscriber start a new task whatever ended this one
+        if self._task is task:
+            self._task = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Lettura degli eventi interrotta", exc_info=task.exception())
+
+    async def wait_ready(self, timeout):
+        """Wait until the task has read the current last event id"""
+        await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+
+    async def replay(self, after_id):
+        """
+        Events committed after after_id, for a client that reconnects
+
+        Returns:
+            tuple: The events and whether more than EVENTS_REPLAY_LIMIT were missed
+        """
+        async with self.sessionmaker() as session:
+            events = (await session.scalars(
+                select(ChangeEvent).where(ChangeEvent.id > after_id)
+                .order_by(ChangeEvent.id).limit(EVENTS_REPLAY_LIMIT + 1)
+            )).all()
+        truncated = len(events) > EVENTS_REPLAY_LIMIT
+        return [event.to_dict() for event in events[:EVENTS_REPLAY_LIMIT]], truncated
+
+    async def _run(self):
+        delivered = set()
+
+        while True:
+            try:
+                async with self.sessionmaker() as session:
+                    if self.last_id is None:
+                        last_id = await session.scalar(select(func.coalesce(func.max(ChangeEvent.id), 0)))
+                        delivered = set((await session.scalars(
+                            select(ChangeEvent.id).where(ChangeEvent.id > last_id - EVENTS_REORDER_WINDOW)
+                        )).all())
+                        self.last_id = last_id
+                        self._ready.set()
+                        events = []
+                    else:
+                        events = (await session.scalars(
+                            select(ChangeEvent).where(
+                                ChangeEvent.id > self.last_id - EVENTS_REORDER_WINDOW,
+                                ChangeEvent.id.not_in(delivered),
+                            ).order_by(ChangeEvent.id)
+                        )).all()
+            except Exception:
+                logger.exception("Errore durante la lettura degli eventi")
+                events = []
+
+            for event in events:
+                delivered.add(event.id)
+                self.last_id = max(self.last_id, event.id)
+                payload = event.to_dict()
+                for subscription in list(self.subscribers):
+                    if subscription.queue.full():
+                        # The stream sends a reset once the queued events are read
+                        subscription.overflowed = True
+                        self.subscribers.discard(subscription)
+                    else:
+                        subscription.queue.put_nowait(payload)
+            if self.last_id is not None:
+                delivered = {event_id for event_id in delivered if event_id > self.last_id - EVENTS_REORDER_WINDOW}
+
+            await asyncio.sleep(EVENTS_POLL_INTERVAL)
+
+
+class AsyncDatabase:
+    """Async engine, session factory and event broadcaster of one database"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.sessionmaker = async_sessionmaker(engine, expire_on_commit=False)
+        self.broadcaster = ChangeBroadcaster(self.sessionmaker)
+
+    @classmethod
+    def from_url(cls, url):
+        engine_options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        async_url, connect_args = to_async_url(url)
+        engine_options["connect_args"] = {**engine_options.get("connect_args", {}), **connect_args}
+        return cls(create_async_engine(async_url, **engine_options))
+
+    async def has_tables(self, schema=None):
+        async with self.engine.connect() as connection:
+            return await connection.run_sync(
+                lambda sync_connection: inspect(sync_connection).has_table('panel', schema=schema)
+            )
+
+    async def dispose(self):
+        self.broadcaster.close()
+        await self.engine.dispose()
+
+
+class AsyncTenantDatabases:
+    """
+    Bounded LRU of per-tenant AsyncDatabase, mirroring TenantEngineCache.
+
+    Tenants with connected SSE clients are never evicted, so the cache may
+    temporarily hold more than TENANT_ENGINE_CACHE_SIZE databases.
+    """
+
+    def __init__(self, tenant_engines):
+        self.tenant_engines = tenant_engines
+        self._databases = OrderedDict()
+        self._shared = None
+
+    def _create(self, tenant):
+        if self.tenant_engines.per_database:
+            return AsyncDatabase.from_url(self.tenant_engines.url_for(tenant))
+        if self._shared is None:
+            self._shared = AsyncDatabase.from_url(self.tenant_engines.url_for(tenant))
+        return AsyncDatabase(self._shared.engine.execution_options(schema_translate_map={None: tenant}))
+
+    async def get(self, tenant):
+        database = self._databases.get(tenant)
+        if database is not None:
+            self._databases.move_to_end(tenant)
+            return database
+
+        if self.tenant_engines.file_missing(tenant):
+            return None
+        database = self._create(tenant)
+        schema = None if self.tenant_engines.per_database else tenant
+        if not await database.has_tables(schema):
+            await self._release(database)
+            return None
+
+        # Another request may have created it while we were checking
+        if tenant in self._databases:
+            await self._release(database)
+            return await self.get(tenant)
+
+        self._databases[tenant] = database
+        await self._evict(keep=tenant)
+        return database
+
+    async def _evict(self, keep):
+        for old_tenant in list(self._databases):
+            if len(self._databases) <= self.tenant_engines.max_size:
+                break
+            old_database = self._databases[old_tenant]
+            if old_tenant == keep or old_database.broadcaster.subscribers:
+                continue
+            del self._databases[old_tenant]
+            logger.debug("Releasing async engine of idle tenant %s", old_tenant)
+            await self._release(old_database)
+
+    async def _release(self, database):
+        # Schema databases share the pool of the base engine, which stays open
+        if self.tenant_engines.per_database:
+            await database.dispose()
+        else:
+            database.broadcaster.close()
+
+    async def dispose(self):
+        for database in self._databases.values():
+            await self._release(database)
+        self._databases.clear()
+        if self._shared is not None:
+            await self._shared.dispose()
+
+
+def _create_databases():
+    tenant_engines = app.extensions.get("tenant_engines")
+    if tenant_engines is not None:
+        return AsyncTenantDatabases(tenant_engines)
+    with app.app_context():
+        # Resolved like the Flask app does, e.g. relative SQLite paths
+        return AsyncDatabase.from_url(db.engine.url)
+
+
+databases = _create_databases()
+
+
+def request_host(request):
+    """The host name as seen by the Flask app behind ProxyFix(x_host=1)"""
+    forwarded_host = request.headers.get('x-forwarded-host')
+    if forwarded_host:
+        return forwarded_host.split(',')[-1].strip()
+    return request.headers.get('host')
+
+
+async def get_database(request):
+    """Return the AsyncDatabase of the request, resolving the tenant if enabled"""
+    if isinstance(databases, AsyncDatabase):
+        return databases
+
+    tenant = tenant_from(app.config, request.headers, request_host(request))
+    database = await databases.get(tenant) if tenant else None
+    if database is None:
+        raise HTTPException(status_code=404)
+    return database
+
+
+async def inventory(request):
+    """Extracts in inventory sorted by expiration date (closest first)"""
+    database = await get_database(request)
+    async with database.sessionmaker() as session:
+        extracts = (await session.scalars(
+            select(InventoryExtract).order_by(InventoryExtract.expiration_date.asc())
+        )).all()
+    return JSONResponse([extract.to_dict() for extract in extracts])
+
+
+async def expiring(request):
+    """Extracts expiring within days_threshold days (default 180)"""
+    try:
+        days_threshold = int(request.query_params.get('days_threshold', 180))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="days_threshold non valido")
+    if abs(days_threshold) > MAX_DAYS_THRESHOLD:
+        raise HTTPException(status_code=400, detail="days_threshold fuori intervallo")
+
+    database = await get_database(request)
+    async with database.sessionmaker() as session:
+        extracts = (await session.scalars(expiring_extracts_statement(days_threshold))).all()
+    return JSONResponse({
+        'days_threshold': days_threshold,
+        'extracts': [extract.to_dict() for extract in extracts]
+    })
+
+
+async def panels(request):
+    """All panels with their extracts"""
+    database = await get_database(request)
+    async with database.sessionmaker() as session:
+        panels_data = (await session.scalars(
+            select(Panel).options(selectinload(Panel.extracts)).order_by(Panel.id)
+        )).all()
+    return JSONResponse([panel.to_dict() for panel in panels_data])
+
+
+async def panel_detail(request):
+    """A single panel with its extracts"""
+    database = await get_database(request)
+    async with database.sessionmaker() as session:
+        panel = await session.scalar(
+            select(Panel).options(selectinload(Panel.extracts))
+            .where(Panel.id == request.path_params['panel_id'])
+        )
+    if panel is None:
+        raise HTTPException(status_code=404)
+    return JSONResponse(panel.to_dict())
+
+
+async def counters(request):
+    """The homepage counters"""
+    database = await get_database(request)
+    async with database.sessionmaker() as session:
+        values = {name: await session.scalar(statement) for name, statement in counter_statements().items()}
+    return JSONResponse(values)
+
+
+async def events(request):
+    """
+    Server-sent events stream of panel/inventory changes.
+
+    Clients reconnecting with Last-Event-ID first receive the events they
+    missed. When that is not possible (too many missed events, or the client
+    reads too slowly) the stream sends a ``reset`` event and closes: the client
+    reloads its state and reconnects.
+    """
+    # Answers 404 before the stream starts
+    await get_database(request)
+    try:
+        last_event_id = int(request.headers.get('last-event-id', ''))
+    except ValueError:
+        last_event_id = None
+
+    async def stream():
+        # Looked up again and subscribed with no await in between: the database
+        # found above may have been evicted while the response was starting
+        try:
+            database = await get_database(request)
+        except HTTPException:
+            return
+        broadcaster = database.broadcaster
+        subscription = broadcaster.subscribe()
+        try:
+            yield "retry: 5000\n\n"
+            # Once the task has its starting id, later events reach the queue, so
+            # the replay below cannot leave a gap
+            while True:
+                try:
+                    await broadcaster.wait_ready(EVENTS_KEEPALIVE)
+                    break
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+
+            sent = set()
+            if last_event_id is None:
+                # Gives the client a position to reconnect from
+                yield f"id: {broadcaster.last_id}\n\n"
+            else:
+                try:
+                    missed, truncated = await broadcaster.replay(last_event_id)
+                except Exception:
+                    logger.exception("Errore durante il recupero degli eventi persi")
+                    yield format_reset(broadcaster.last_id)
+                    return
+                if truncated:
+                    yield format_reset(broadcaster.last_id)
+                    return
+                for event in missed:
+                    sent.add(event['id'])
+                    yield format_event(event)
+
+            while True:
+                if subscription.overflowed and subscription.queue.empty():
+                    yield format_reset(broadcaster.last_id)
+                    return
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), timeout=EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing the idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                if event['id'] not in sent:
+                    yield format_event(event)
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@asynccontextmanager
+async def lifespan(asgi_app):
+    yield
+    await databases.dispose()
+
+
+asgi_app = Starlette(
+    routes=[
+        Route('/api/inventory', inventory),
+        Route('/api/inventory/expiring', expiring),
+        Route('/api/panels', panels),
+        Route('/api/panels/{panel_id:int}', panel_detail),
+        Route('/api/counters', counters),
+        Route('/api/events', events),
+    ],
+    lifespan=lifespan,
+)
@@ -2,8 +2,28 @@ import os
 from datetime import datetime, timedelta
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Email, To, Content
+from sqlalchemy import select
+from app import db
 from models import InventoryExtract
 
+# Oltre questa soglia la data calcolata esce dall'intervallo supportato
+MAX_DAYS_THRESHOLD = 36500
+
+def expiring_extracts_statement(days_threshold=180):
+    """
+    Costruisce la query degli estratti in scadenza, condivisa con l'API asincrona.
+    
+    Args:
+        days_threshold (int): Numero di giorni prima della scadenza per considerare un estratto come "in scadenza"
+    
+    Returns:
+        Select: Query SQLAlchemy sugli InventoryExtract in scadenza
+    """
+    threshold_date = datetime.now().date() + timedelta(days=days_threshold)
+    return select(InventoryExtract).where(
+        InventoryExtract.expiration_date <= threshold_date
+    ).order_by(InventoryExtract.expiration_date)
+
 def get_expiring_extracts(days_threshold=180):
     """
     Ottiene gli estratti in scadenza entro il numero di giorni specificato.
@@ -14,10 +34,7 @@ def get_expiring_extracts(days_threshold=180):
     Returns:
         list: Lista di InventoryExtract in scadenza
     """
-    threshold_date = datetime.now().date() + timedelta(days=days_threshold)
-    return InventoryExtract.query.filter(
-        InventoryExtract.expiration_date <= threshold_date
-    ).order_by(InventoryExtract.expiration_date).all()
+    return db.session.scalars(expiring_extracts_statement(days_threshold)).all()
 
 def send_expiration_notification(to_email, expiring_extracts, days_threshold):
     """
@@ -118,3 +118,22 @@ class ExtractUsageHistory(db.Model):
             'end_date': self.end_date.strftime('%Y-%m-%d') if self.end_date else None,
             'panel_name': self.panel_name
         }
+
+
+class ChangeEvent(db.Model):
+    """Model for panel/inventory changes pushed to live clients (see async_api.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # panel, inventory
+    panel_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now, index=True)
+    
+    def __repr__(self):
+        return f"<ChangeEvent {self.id} {self.kind}>"
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'panel_id': self.panel_id,
+            'created_at': self.created_at.strftime('%Y-%m-%dT%H:%M:%S') if self.created_at else None
+        }
@@ -6,8 +6,8 @@ from sqlalchemy import extract as sql_extract
 
 from app import app, db
 from models import Panel, PanelExtract, InventoryExtract, ExtractUsageHistory
-from utils import find_replacement_extract
-from email_utils import get_expiring_extracts, send_expiration_notification
+from utils import find_replacement_extract, counter_statements, record_change
+from email_utils import get_expiring_extracts, send_expiration_notification, MAX_DAYS_THRESHOLD
 
 # Helper function to use in templates to get current date
 @app.context_processor
@@ -18,25 +18,10 @@ def inject_now():
 @app.route('/')
 def home():
     """Homepage route"""
-    panel_count = Panel.query.count()
-    active_extracts = PanelExtract.query.filter_by(end_date=None).count()
-    inventory_count = InventoryExtract.query.count()
-    
-    # Count extracts expiring in the next 30 days
-    from datetime import timedelta
-    today = datetime.now().date()
-    # Use timedelta instead of day replacement to avoid issues with month boundaries
-    thirty_days_later = today + timedelta(days=30)
-    soon_expiring = InventoryExtract.query.filter(
-        InventoryExtract.expiration_date >= today,
-        InventoryExtract.expiration_date <= thirty_days_later
-    ).count()
-    
-    return render_template('home.html', 
-                           panel_count=panel_count,
-                           active_extracts=active_extracts,
-                           inventory_count=inventory_count,
-                           soon_expiring=soon_expiring)
+    # panel_count, active_extracts, inventory_count and soon_expiring (next 30 days)
+    counters = {name: db.session.scalar(statement) for name, statement in counter_statements().items()}
+    
+    return render_template('home.html', **counters)
 
 
 @app.route('/panels')
@@ -64,6 +49,8 @@ def add_panel():
     
     new_panel = Panel(name=name, description=description)
     db.session.add(new_panel)
+    db.session.flush()
+    record_change('panel', new_panel.id)
     db.session.commit()
     
     flash(f'Pannello "{name}" aggiunto con successo', 'success')
@@ -79,6 +66,7 @@ def delete_panel(panel_id):
     # Delete all associated extracts (this will also delete the panel due to cascading)
     PanelExtract.query.filter_by(panel_id=panel_id).delete()
     db.session.delete(panel)
+    record_change('panel', panel_id)
     db.session.commit()
     
     flash(f'Pannello "{panel_name}" eliminato con successo', 'success')
@@ -119,6 +107,8 @@ def add_extract_to_panel(panel_id):
     # Add the extract to the panel and remove from inventory
     db.session.add(panel_extract)
     db.session.delete(inventory_extract)
+    record_change('panel', panel_id)
+    record_change('inventory')
     db.session.commit()
     
     flash(f'Estratto "{inventory_extract.name}" aggiunto al pannello', 'success')
@@ -163,11 +153,13 @@ def close_extract(extract_id):
         # Add the new extract and remove from inventory
         db.session.add(new_extract)
         db.session.delete(replacement)
+        record_change('inventory')
         
         flash(f'Estratto chiuso e sostituito con uno nuovo dall\'inventario', 'success')
     else:
         flash(f'Estratto chiuso. Nessun sostituto trovato nell\'inventario.', 'warning')
     
+    record_change('panel', panel_id)
     db.session.commit()
     return redirect(url_for('panel_detail', panel_id=panel_id))
 
@@ -222,6 +214,7 @@ def add_inventory():
         )
         db.session.add(new_extract)
     
+    record_change('inventory')
     db.session.commit()
     
     if quantity == 1:
@@ -302,6 +295,7 @@ def delete_inventory_extract(extract_id):
     extract_name = extract.name
     
     db.session.delete(extract)
+    record_change('inventory')
     db.session.commit()
     
     flash(f'Estratto "{extract_name}" eliminato dall\'inventario', 'success')
@@ -313,6 +307,9 @@ def notifications():
     """Pagina delle notifiche con form per l'invio email"""
     # Default a 180 giorni (6 mesi)
     days_threshold = request.args.get('days_threshold', 180, type=int)
+    if abs(days_threshold) > MAX_DAYS_THRESHOLD:
+        flash(f'La soglia non può superare {MAX_DAYS_THRESHOLD} giorni', 'danger')
+        return redirect(url_for('notifications'))
     
     # Ottieni gli estratti in scadenza
     expiring_extracts = get_expiring_extracts(days_threshold)
@@ -326,7 +323,14 @@ def notifications():
 def send_notifications():
     """Invia notifiche email per gli estratti in scadenza"""
     email = request.form.get('email')
-    days_threshold = int(request.form.get('days_threshold', 180))
+    try:
+        days_threshold = int(request.form.get('days_threshold', 180))
+    except ValueError:
+        flash('Formato soglia non valido', 'danger')
+        return redirect(url_for('notifications'))
+    if abs(days_threshold) > MAX_DAYS_THRESHOLD:
+        flash(f'La soglia non può superare {MAX_DAYS_THRESHOLD} giorni', 'danger')
+        return redirect(url_for('notifications'))
     
     if not email:
         flash('L\'indirizzo email è obbligatorio', 'danger')
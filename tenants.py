@@ -0,0 +1,330 @@
+import os
+import re
+import glob
+import logging
+import threading
+from collections import OrderedDict
+
+import click
+from flask import g, request, abort, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import make_url
+
+
+logger = logging.getLogger(__name__)
+
+# Tenant names end up in file paths and schema names, so keep them strict
+TENANT_NAME_RE = re.compile(r'^[a-z0-9][a-z0-9_-]{0,62}$')
+# Schemas that hold the single-clinic data or the database catalog
+RESERVED_TENANT_NAMES = {'public', 'information_schema'}
+
+
+def is_valid_tenant_name(name):
+    """Check that a tenant name is safe and is not a reserved/system schema"""
+    return (bool(TENANT_NAME_RE.match(name))
+            and name not in RESERVED_TENANT_NAMES
+            and not name.startswith('pg_'))
+
+
+class TenantSession(Session):
+    """Session that uses the engine of the current tenant when one is resolved"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            tenant_engine = g.get('tenant_engine')
+            if tenant_engine is not None:
+                return tenant_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class TenantEngineCache:
+    """
+    Bounded LRU cache of per-tenant engines.
+
+    The tenant URL template decides the layout:
+    - SQLite, with a ``{tenant}`` placeholder: every clinic has its own file
+      (e.g. ``sqlite:///tenants/{tenant}.db``) and its own engine/pool;
+      engines evicted from the cache are disposed so idle tenants release
+      their connections.
+    - Other databases, without a placeholder: every clinic is a schema of
+      the same database; all tenants share one pool and the schema is
+      selected with ``schema_translate_map``.
+    """
+
+    def __init__(self, url_template, engine_options=None, max_size=16, base_path=None):
+        self.url_template = url_template
+        self.engine_options = dict(engine_options or {})
+        self.max_size = max(1, max_size)
+        self.base_path = base_path
+        self.per_database = '{tenant}' in url_template
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared_engine = None
+        self._check_layout()
+        if not self.per_database:
+            self._shared_engine = create_engine(self.url_for(None), **self.engine_options)
+
+    def _check_layout(self):
+        backend = make_url(self.url_template.replace('{tenant}', 'tenant')).get_backend_name()
+        if backend == 'sqlite' and not self.per_database:
+            raise RuntimeError("TENANT_DATABASE_URL SQLite deve contenere {tenant}: SQLite non supporta gli schemi")
+        if backend != 'sqlite' and self.per_database:
+            raise RuntimeError(
+                "TENANT_DATABASE_URL non SQLite non deve contenere {tenant}: ogni tenant è uno schema"
+            )
+
+    def url_for(self, tenant):
+        """Return the database URL of a tenant"""
+        url = make_url(self.url_template.format(tenant=tenant) if self.per_database else self.url_template)
+        # Relative SQLite paths are resolved like Flask-SQLAlchemy does for DATABASE_URL
+        if (url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+                and self.base_path and not os.path.isabs(url.database)):
+            url = url.set(database=os.path.join(self.base_path, url.database))
+        return url
+
+    def _sqlite_path(self, tenant):
+        url = self.url_for(tenant)
+        if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+            return url.database
+        return None
+
+    def create_engine(self, tenant):
+        """Create a new engine for the tenant, outside of the cache"""
+        if self.per_database:
+            return create_engine(self.url_for(tenant), **self.engine_options)
+        return self._shared_engine.execution_options(schema_translate_map={None: tenant})
+
+    def _release(self, engine):
+        # Schema engines share the pool of the base engine, which stays open
+        if self.per_database:
+            engine.dispose()
+
+    def _has_tables(self, engine, tenant):
+        schema = None if self.per_database else tenant
+        return inspect(engine).has_table('panel', schema=schema)
+
+    def file_missing(self, tenant):
+        """
+        Check whether the SQLite file of the tenant is missing.
+        Connecting to a missing SQLite file would silently create it, so this
+        must be checked before creating an engine for an unknown tenant.
+        """
+        sqlite_path = self._sqlite_path(tenant)
+        return sqlite_path is not None and not os.path.exists(sqlite_path)
+
+    def exists(self, tenant):
+        """Check whether the tenant database or schema has been created"""
+        if self.file_missing(tenant):
+            return False
+        engine = self.create_engine(tenant)
+        try:
+            return self._has_tables(engine, tenant)
+        finally:
+            self._release(engine)
+
+    def get(self, tenant):
+        """
+        Get the engine for an existing tenant, creating it if needed
+
+        Returns:
+            Engine or None: None if the tenant has not been created
+        """
+        with self._lock:
+            engine = self._engines.get(tenant)
+            if engine is not None:
+                self._engines.move_to_end(tenant)
+                return engine
+
+        if self.file_missing(tenant):
+            return None
+        engine = self.create_engine(tenant)
+        if not self._has_tables(engine, tenant):
+            self._release(engine)
+            return None
+
+        evicted = []
+        with self._lock:
+            # Another request may have created it in the meantime
+            if tenant in self._engines:
+                evicted.append(engine)
+                engine = self._engines[tenant]
+                self._engines.move_to_end(tenant)
+            else:
+                self._engines[tenant] = engine
+                while len(self._engines) > self.max_size:
+                    old_tenant, old_engine = self._engines.popitem(last=False)
+                    logger.debug("Releasing engine of idle tenant %s", old_tenant)
+                    evicted.append(old_engine)
+
+        # Checked-out connections are closed when they are returned to the pool
+        for old_engine in evicted:
+            self._release(old_engine)
+        return engine
+
+    def list_tenants(self):
+        """List the created tenants, when the layout allows discovering them"""
+        if not self.per_database:
+            engine = self.create_engine('public')
+            schemas = inspect(engine).get_schema_names()
+            return sorted(s for s in schemas if is_valid_tenant_name(s) and self.exists(s))
+
+        sqlite_path = self._sqlite_path('*')
+        if sqlite_path is None:
+            raise click.ClickException(
+                "L'elenco dei tenant è disponibile solo per database SQLite o schemi"
+            )
+        prefix, suffix = sqlite_path.split('*', 1)
+        tenants = []
+        for path in glob.glob(sqlite_path):
+            tenant = path[len(prefix):len(path) - len(suffix)]
+            if is_valid_tenant_name(tenant):
+                tenants.append(tenant)
+        return sorted(tenants)
+
+    def create_tenant(self, metadata, tenant):
+        """Create the database/schema of a tenant and all its tables"""
+        sqlite_path = self._sqlite_path(tenant)
+        if sqlite_path is not None:
+            directory = os.path.dirname(os.path.abspath(sqlite_path))
+            os.makedirs(directory, exist_ok=True)
+        self.migrate_tenant(metadata, tenant)
+
+    def migrate_tenant(self, metadata, tenant):
+        """Create the tables missing from the tenant database/schema"""
+        engine = self.create_engine(tenant)
+        try:
+            with engine.begin() as connection:
+                if not self.per_database:
+                    connection.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{tenant}"'))
+                metadata.create_all(connection)
+        finally:
+            self._release(engine)
+
+    def dispose(self):
+        """Release every cached engine"""
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+        for engine in engines:
+            self._release(engine)
+        if not self.per_database:
+            self._shared_engine.dispose()
+
+
+def tenant_from(config, headers, host):
+    """
+    Resolve the tenant from the request headers and host name.
+
+    Exactly one source is trusted: the header named in TENANT_HEADER (which the
+    reverse proxy must set, overwriting any value sent by the client) or, with
+    TENANT_FROM_SUBDOMAIN, the host name ``<tenant>.<TENANT_BASE_DOMAIN>``.
+
+    Returns:
+        str or None: The tenant name, or None if it is missing or invalid
+    """
+    if config["TENANT_FROM_SUBDOMAIN"]:
+        tenant = None
+        host_name = host.split(':', 1)[0].lower().rstrip('.') if host else ''
+        suffix = '.' + config["TENANT_BASE_DOMAIN"].lower().strip('.')
+        if host_name.endswith(suffix):
+            tenant = host_name[:-len(suffix)]
+            # Only a single label in front of the base domain
+            if '.' in tenant:
+                tenant = None
+    else:
+        tenant = headers.get(config["TENANT_HEADER"])
+
+    if not tenant:
+        return None
+    tenant = tenant.strip().lower()
+    if not is_valid_tenant_name(tenant):
+        return None
+    return tenant
+
+
+def init_tenancy(app, db):
+    """
+    Enable the multi-tenant mode if TENANT_DATABASE_URL is configured.
+
+    Every request is bound to the engine of its tenant, and the ``flask tenants``
+    commands are registered to create and migrate tenants in bulk.
+    """
+    app.config.setdefault("TENANT_DATABASE_URL", os.environ.get("TENANT_DATABASE_URL"))
+    app.config.setdefault("TENANT_ENGINE_CACHE_SIZE", int(os.environ.get("TENANT_ENGINE_CACHE_SIZE", 16)))
+    app.config.setdefault("TENANT_HEADER", os.environ.get("TENANT_HEADER"))
+    app.config.setdefault("TENANT_FROM_SUBDOMAIN", os.environ.get("TENANT_FROM_SUBDOMAIN", "") == "1")
+    app.config.setdefault("TENANT_BASE_DOMAIN", os.environ.get("TENANT_BASE_DOMAIN"))
+
+    url_template = app.config["TENANT_DATABASE_URL"]
+    if not url_template:
+        return None
+
+    # The header and the subdomain are mutually exclusive, otherwise a client could
+    # pick another clinic by sending the header
+    if bool(app.config["TENANT_HEADER"]) == bool(app.config["TENANT_FROM_SUBDOMAIN"]):
+        raise RuntimeError("Configurare TENANT_HEADER oppure TENANT_FROM_SUBDOMAIN=1 (uno solo dei due)")
+    if app.config["TENANT_FROM_SUBDOMAIN"] and not app.config["TENANT_BASE_DOMAIN"]:
+        raise RuntimeError("TENANT_FROM_SUBDOMAIN richiede TENANT_BASE_DOMAIN (es. cliniche.example.com)")
+
+    engines = TenantEngineCache(
+        url_template,
+        engine_options=app.config.get("SQLALCHEMY_ENGINE_OPTIONS"),
+        max_size=app.config["TENANT_ENGINE_CACHE_SIZE"],
+        base_path=app.instance_path,
+    )
+    app.extensions["tenant_engines"] = engines
+
+    @app.before_request
+    def bind_tenant():
+        if request.endpoint == 'static':
+            return None
+        tenant = tenant_from(app.config, request.headers, request.host)
+        engine = engines.get(tenant) if tenant else None
+        if engine is None:
+            abort(404)
+        g.tenant = tenant
+        g.tenant_engine = engine
+        return None
+
+    tenants_cli = click.Group('tenants', help="Gestione dei tenant (cliniche)")
+
+    def _validate_names(names):
+        for name in names:
+            if not is_valid_tenant_name(name):
+                raise click.BadParameter(f'Nome tenant non valido: "{name}"')
+
+    @tenants_cli.command('list')
+    def list_command():
+        """Elenca i tenant esistenti"""
+        for tenant in engines.list_tenants():
+            click.echo(tenant)
+
+    @tenants_cli.command('create')
+    @click.argument('names', nargs=-1)
+    @click.option('--from-file', 'from_file', type=click.File('r'),
+                  help="File con un nome di tenant per riga")
+    def create_command(names, from_file):
+        """Crea uno o più tenant con tutte le tabelle"""
+        names = list(names)
+        if from_file is not None:
+            names.extend(line.strip() for line in from_file if line.strip())
+        if not names:
+            raise click.UsageError("Indicare almeno un tenant o --from-file")
+        _validate_names(names)
+        for name in names:
+            engines.create_tenant(db.metadata, name)
+            click.echo(f'Tenant "{name}" creato')
+
+    @tenants_cli.command('migrate')
+    @click.argument('names', nargs=-1)
+    def migrate_command(names):
+        """Crea le tabelle mancanti nei tenant indicati (o in tutti)"""
+        names = list(names) or engines.list_tenants()
+        _validate_names(names)
+        for name in names:
+            engines.migrate_tenant(db.metadata, name)
+            click.echo(f'Tenant "{name}" aggiornato')
+
+    app.cli.add_command(tenants_cli)
+    return engines
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# app.py configures the database at import time: keep the tests away from the real one
+_database_dir = tempfile.mkdtemp(prefix="allergy-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_database_dir, 'allergy_extracts.db')}"
+os.environ.pop("TENANT_DATABASE_URL", None)
@@ -0,0 +1,315 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from sqlalchemy import event, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import async_api
+import routes  # noqa: F401
+from app import app, db
+from models import ChangeEvent, Panel, InventoryExtract
+from tenants import TenantEngineCache
+
+
+@pytest.fixture(autouse=True)
+def clean_database(monkeypatch):
+    monkeypatch.setattr(async_api, "EVENTS_POLL_INTERVAL", 0.05)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    yield
+
+
+def run(coroutine):
+    """Run a coroutine in a fresh loop, releasing the connections bound to it"""
+    async def wrapper():
+        try:
+            return await coroutine
+        finally:
+            await async_api.databases.dispose()
+    return asyncio.run(wrapper())
+
+
+async def get(path, headers=None):
+    transport = httpx.ASGITransport(app=async_api.asgi_app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+        return await client.get(path, headers=headers)
+
+
+def add_inventory(name, expiration_date, quantity=1):
+    return app.test_client().post('/inventory/add', data={
+        'name': name,
+        'type': 'inalante',
+        'lot_number': 'L1',
+        'manufacturer': 'M',
+        'expiration_date': expiration_date.strftime('%Y-%m-%d'),
+        'quantity': quantity,
+    })
+
+
+class EventStream:
+    """Drive /api/events directly over ASGI, since the stream never ends"""
+
+    def __init__(self, headers=()):
+        self.headers = [(name.lower().encode(), value.encode()) for name, value in headers]
+        self.body = ''
+        self._disconnected = asyncio.Event()
+
+    async def __aenter__(self):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+            'method': 'GET', 'scheme': 'http', 'path': '/api/events', 'raw_path': b'/api/events',
+            'query_string': b'', 'root_path': '', 'headers': self.headers,
+            'server': ('testserver', 80), 'client': ('testclient', 1234),
+        }
+
+        async def receive():
+            await self._disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.body':
+                self.body += message.get('body', b'').decode()
+
+        self._task = asyncio.create_task(async_api.asgi_app(scope, receive, send))
+        await self.wait_for('id: ')
+        # Let the broadcaster read the current last event id
+        await asyncio.sleep(async_api.EVENTS_POLL_INTERVAL * 3)
+        return self
+
+    async def wait_for(self, text, count=1, timeout=3):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.body.count(text) < count:
+            assert asyncio.get_running_loop().time() < deadline, self.body
+            await asyncio.sleep(0.02)
+
+    async def closed(self, timeout=3):
+        """Wait for the server to end the stream by itself"""
+        await asyncio.wait_for(asyncio.shield(self._task), timeout=timeout)
+
+    async def __aexit__(self, *exc_info):
+        self._disconnected.set()
+        await asyncio.wait_for(self._task, timeout=3)
+
+
+def test_read_endpoints():
+    today = datetime.now().date()
+    add_inventory('Acari', today + timedelta(days=10), quantity=2)
+    add_inventory('Graminacee', today + timedelta(days=400))
+    app.test_client().post('/panels/add', data={'name': 'P1'})
+
+    async def scenario():
+        inventory = await get('/api/inventory')
+        expiring = await get('/api/inventory/expiring?days_threshold=30')
+        panels = await get('/api/panels')
+        missing_panel = await get('/api/panels/99')
+        counters = await get('/api/counters')
+        return inventory, expiring, panels, missing_panel, counters
+
+    inventory, expiring, panels, missing_panel, counters = run(scenario())
+    assert [extract['name'] for extract in inventory.json()] == ['Acari', 'Acari', 'Graminacee']
+    assert [extract['name'] for extract in expiring.json()['extracts']] == ['Acari', 'Acari']
+    assert [panel['name'] for panel in panels.json()] == ['P1']
+    assert missing_panel.status_code == 404
+    assert counters.json() == {
+        'panel_count': 1, 'active_extracts': 0, 'inventory_count': 3, 'soon_expiring': 2
+    }
+
+
+@pytest.mark.parametrize("days_threshold", ["abc", "99999999", "-99999999"])
+def test_expiring_rejects_invalid_threshold(days_threshold):
+    response = run(get(f'/api/inventory/expiring?days_threshold={days_threshold}'))
+    assert response.status_code == 400
+
+
+def test_notifications_reject_out_of_range_threshold():
+    client = app.test_client()
+    assert client.get('/notifications?days_threshold=99999999').status_code == 302
+    response = client.post('/notifications/send', data={'email': 'a@b.it', 'days_threshold': '99999999'})
+    assert response.status_code == 302
+
+
+def test_to_async_url_translates_libpq_options():
+    url, connect_args = async_api.to_async_url(
+        make_url("postgresql://user:pw@host/db?sslmode=require&channel_binding=require")
+    )
+    assert url.drivername == 'postgresql+asyncpg'
+    assert dict(url.query) == {}
+    assert connect_args == {'ssl': 'require'}
+
+    url, connect_args = async_api.to_async_url(make_url("sqlite:///allergy.db"))
+    assert url.drivername == 'sqlite+aiosqlite'
+    assert connect_args == {}
+
+
+def test_request_host_matches_proxy_fix():
+    class FakeRequest:
+        def __init__(self, headers):
+            self.headers = headers
+
+    assert async_api.request_host(FakeRequest({
+        'host': 'internal:5001', 'x-forwarded-host': 'spoofed.example.com, alpha.example.com'
+    })) == 'alpha.example.com'
+    assert async_api.request_host(FakeRequest({'host': 'beta.example.com'})) == 'beta.example.com'
+
+
+def test_events_are_pushed_after_writes():
+    today = datetime.now().date()
+
+    async def scenario():
+        async with EventStream() as stream:
+            add_inventory('Acari', today + timedelta(days=10))
+            await stream.wait_for('event: inventory')
+
+            client = app.test_client()
+            client.post('/panels/add', data={'name': 'P1'})
+            with app.app_context():
+                inventory_id = db.session.scalar(db.select(InventoryExtract.id))
+            client.post('/panels/1/add_extract', data={'inventory_id': inventory_id})
+            with app.app_context():
+                extract_id = db.session.scalars(db.select(Panel)).one().extracts[0].id
+            client.post(f'/panels/extract/{extract_id}/close')
+            await stream.wait_for('event: panel', count=3)
+        return stream.body
+
+    body = run(scenario())
+    assert 'data: {"id": 1, "kind": "inventory"' in body
+
+
+def test_reconnecting_client_receives_missed_events():
+    today = datetime.now().date()
+    add_inventory('Acari', today + timedelta(days=10))
+    add_inventory('Graminacee', today + timedelta(days=10))
+
+    async def scenario():
+        async with EventStream(headers=[('Last-Event-ID', '1')]) as stream:
+            await stream.wait_for('id: 2')
+        return stream.body
+
+    body = run(scenario())
+    assert 'id: 1\n' not in body
+    assert body.count('id: 2\n') == 1
+
+
+def test_new_client_receives_its_position():
+    add_inventory('Acari', datetime.now().date() + timedelta(days=10))
+
+    async def scenario():
+        async with EventStream() as stream:
+            pass
+        return stream.body
+
+    assert 'id: 1\n\n' in run(scenario())
+
+
+def test_too_many_missed_events_send_a_reset(monkeypatch):
+    monkeypatch.setattr(async_api, "EVENTS_REPLAY_LIMIT", 1)
+    add_inventory('Acari', datetime.now().date() + timedelta(days=10))
+    add_inventory('Graminacee', datetime.now().date() + timedelta(days=10))
+
+    async def scenario():
+        async with EventStream(headers=[('Last-Event-ID', '0')]) as stream:
+            await stream.closed()
+        return stream.body
+
+    body = run(scenario())
+    assert 'event: inventory' not in body
+    assert body.endswith('id: 2\nevent: reset\ndata: {}\n\n')
+
+
+def test_slow_client_gets_a_reset(monkeypatch):
+    monkeypatch.setattr(async_api, "EVENTS_QUEUE_SIZE", 1)
+
+    async def scenario():
+        async with EventStream() as stream:
+            with app.app_context():
+                for _ in range(3):
+                    db.session.add(ChangeEvent(kind='inventory'))
+                db.session.commit()
+            await stream.closed()
+        return stream.body
+
+    body = run(scenario())
+    assert body.count('event: inventory') == 1
+    assert body.endswith('id: 3\nevent: reset\ndata: {}\n\n')
+
+
+def test_broadcaster_recovers_when_table_is_missing(tmp_path):
+    database_path = tmp_path / 'old.db'
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database_path}")
+        broadcaster = async_api.ChangeBroadcaster(async_sessionmaker(engine))
+        subscription = broadcaster.subscribe()
+        await asyncio.sleep(0.2)
+        assert broadcaster._task is not None and not broadcaster._task.done()
+
+        # A tenant created before change_event existed, migrated later
+        async with engine.begin() as connection:
+            await connection.run_sync(ChangeEvent.__table__.create)
+        await asyncio.sleep(0.2)
+        async with engine.begin() as connection:
+            await connection.execute(ChangeEvent.__table__.insert().values(
+                kind='inventory', created_at=datetime.now()
+            ))
+        event_payload = await asyncio.wait_for(subscription.queue.get(), timeout=3)
+
+        broadcaster.unsubscribe(subscription)
+        assert broadcaster._task is None
+        await engine.dispose()
+        return event_payload
+
+    assert asyncio.run(scenario())['kind'] == 'inventory'
+
+
+def test_tenants_with_subscribers_are_not_evicted(tmp_path):
+    tenant_engines = TenantEngineCache(f"sqlite:///{tmp_path}/{{tenant}}.db", max_size=1)
+    for tenant in ('alpha', 'beta', 'gamma'):
+        tenant_engines.create_tenant(db.metadata, tenant)
+
+    async def scenario():
+        databases = async_api.AsyncTenantDatabases(tenant_engines)
+        alpha = await databases.get('alpha')
+        subscription = alpha.broadcaster.subscribe()
+
+        await databases.get('beta')
+        assert list(databases._databases) == ['alpha', 'beta']
+        assert await databases.get('alpha') is alpha
+
+        alpha.broadcaster.unsubscribe(subscription)
+        await databases.get('gamma')
+        assert 'alpha' not in databases._databases
+        assert alpha.broadcaster._task is None
+        assert await databases.get('nope') is None
+        await databases.dispose()
+
+    asyncio.run(scenario())
+    tenant_engines.dispose()
+
+
+def test_old_events_are_pruned_once_per_request():
+    add_inventory('Acari', datetime.now().date() + timedelta(days=10))
+    app.test_client().post('/panels/add', data={'name': 'P1'})
+    deletes = []
+
+    with app.app_context():
+        db.session.add(ChangeEvent(kind='panel', created_at=datetime.now() - timedelta(days=2)))
+        db.session.commit()
+        inventory_id = db.session.scalar(db.select(InventoryExtract.id))
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_deletes(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('DELETE FROM change_event'):
+                deletes.append(statement)
+
+    try:
+        app.test_client().post('/panels/1/add_extract', data={'inventory_id': inventory_id})
+    finally:
+        with app.app_context():
+            event.remove(db.engine, 'before_cursor_execute', count_deletes)
+
+    assert len(deletes) == 1
+    with app.app_context():
+        assert db.session.scalar(db.select(db.func.count(ChangeEvent.id))) == 4
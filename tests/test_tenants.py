@@ -0,0 +1,163 @@
+import pytest
+from flask import Flask, jsonify
+
+from app import db
+from models import Panel
+from tenants import TenantEngineCache, init_tenancy, is_valid_tenant_name, tenant_from
+
+
+@pytest.fixture
+def tenant_app(tmp_path):
+    test_app = Flask(__name__)
+    test_app.config.update(
+        SQLALCHEMY_DATABASE_URI="sqlite://",
+        TENANT_DATABASE_URL=f"sqlite:///{tmp_path}/{{tenant}}.db",
+        TENANT_HEADER="X-Tenant",
+        TENANT_ENGINE_CACHE_SIZE=2,
+    )
+    db.init_app(test_app)
+    engines = init_tenancy(test_app, db)
+
+    @test_app.route('/panels')
+    def panels():
+        return jsonify([panel.name for panel in Panel.query.order_by(Panel.name)])
+
+    @test_app.route('/panels/<name>', methods=['POST'])
+    def add_panel(name):
+        db.session.add(Panel(name=name))
+        db.session.commit()
+        return '', 201
+
+    yield test_app
+    engines.dispose()
+
+
+def create_tenants(test_app, *names):
+    result = test_app.test_cli_runner().invoke(args=['tenants', 'create', *names])
+    assert result.exit_code == 0, result.output
+
+
+def test_tenant_from_header():
+    config = {"TENANT_HEADER": "X-Tenant", "TENANT_FROM_SUBDOMAIN": False}
+    assert tenant_from(config, {"X-Tenant": " Alpha "}, "beta.example.com") == "alpha"
+    assert tenant_from(config, {}, "beta.example.com") is None
+    assert tenant_from(config, {"X-Tenant": "../etc"}, None) is None
+
+
+def test_tenant_from_subdomain_ignores_header():
+    config = {"TENANT_HEADER": None, "TENANT_FROM_SUBDOMAIN": True, "TENANT_BASE_DOMAIN": "example.com"}
+    assert tenant_from(config, {"X-Tenant": "beta"}, "alpha.example.com:5000") == "alpha"
+    assert tenant_from(config, {"X-Tenant": "beta"}, "example.com") is None
+
+
+@pytest.mark.parametrize("host", [
+    "myapp.replit.app",
+    "example.co.uk",
+    "alpha.other.example.com",
+    "alpha.notexample.com",
+])
+def test_tenant_from_subdomain_requires_base_domain(host):
+    config = {"TENANT_HEADER": None, "TENANT_FROM_SUBDOMAIN": True, "TENANT_BASE_DOMAIN": "example.com"}
+    assert tenant_from(config, {}, host) is None
+
+
+@pytest.mark.parametrize("name", ["public", "information_schema", "pg_catalog", "pg_toast"])
+def test_reserved_schema_names_are_not_tenants(name):
+    assert not is_valid_tenant_name(name)
+    config = {"TENANT_HEADER": "X-Tenant", "TENANT_FROM_SUBDOMAIN": False}
+    assert tenant_from(config, {"X-Tenant": name}, None) is None
+
+
+def test_subdomain_mode_requires_base_domain(tmp_path):
+    test_app = Flask(__name__)
+    test_app.config.update(
+        TENANT_DATABASE_URL=f"sqlite:///{tmp_path}/{{tenant}}.db",
+        TENANT_FROM_SUBDOMAIN=True,
+        TENANT_BASE_DOMAIN=None,
+    )
+    with pytest.raises(RuntimeError):
+        init_tenancy(test_app, db)
+
+
+@pytest.mark.parametrize("header, from_subdomain", [(None, False), ("X-Tenant", True)])
+def test_init_tenancy_requires_one_tenant_source(tmp_path, header, from_subdomain):
+    test_app = Flask(__name__)
+    test_app.config.update(
+        TENANT_DATABASE_URL=f"sqlite:///{tmp_path}/{{tenant}}.db",
+        TENANT_HEADER=header,
+        TENANT_FROM_SUBDOMAIN=from_subdomain,
+    )
+    with pytest.raises(RuntimeError):
+        init_tenancy(test_app, db)
+
+
+@pytest.mark.parametrize("url_template", [
+    "sqlite:///tenants.db",
+    "postgresql://user@localhost/{tenant}",
+])
+def test_invalid_layouts_are_rejected(url_template):
+    with pytest.raises(RuntimeError):
+        TenantEngineCache(url_template)
+
+
+def test_cli_create_list_migrate(tenant_app, tmp_path):
+    runner = tenant_app.test_cli_runner()
+    names_file = tmp_path / 'names.txt'
+    names_file.write_text("beta\n\ngamma\n")
+
+    result = runner.invoke(args=['tenants', 'create', 'alpha'])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(args=['tenants', 'create', '--from-file', str(names_file)])
+    assert result.exit_code == 0, result.output
+
+    result = runner.invoke(args=['tenants', 'list'])
+    assert result.output.split() == ['alpha', 'beta', 'gamma']
+
+    result = runner.invoke(args=['tenants', 'migrate'])
+    assert result.exit_code == 0, result.output
+    assert result.output.count('aggiornato') == 3
+
+
+def test_cli_create_requires_names(tenant_app):
+    result = tenant_app.test_cli_runner().invoke(args=['tenants', 'create'])
+    assert result.exit_code == 2
+    result = tenant_app.test_cli_runner().invoke(args=['tenants', 'create', 'Not Valid'])
+    assert result.exit_code == 2
+    result = tenant_app.test_cli_runner().invoke(args=['tenants', 'create', 'public'])
+    assert result.exit_code == 2
+
+
+def test_requests_are_bound_to_their_tenant(tenant_app):
+    create_tenants(tenant_app, 'alpha', 'beta')
+    client = tenant_app.test_client()
+
+    assert client.post('/panels/P1', headers={'X-Tenant': 'alpha'}).status_code == 201
+    assert client.get('/panels', headers={'X-Tenant': 'alpha'}).json == ['P1']
+    assert client.get('/panels', headers={'X-Tenant': 'beta'}).json == []
+
+
+def test_unknown_or_missing_tenant_is_not_found(tenant_app, tmp_path):
+    create_tenants(tenant_app, 'alpha')
+    client = tenant_app.test_client()
+
+    assert client.get('/panels').status_code == 404
+    assert client.get('/panels', headers={'X-Tenant': 'nope'}).status_code == 404
+    # The lookup must not create an empty database for the unknown tenant
+    assert not (tmp_path / 'nope.db').exists()
+
+
+def test_idle_tenants_are_evicted_and_released(tenant_app):
+    create_tenants(tenant_app, 'alpha', 'beta', 'gamma')
+    engines = tenant_app.extensions['tenant_engines']
+    client = tenant_app.test_client()
+
+    client.get('/panels', headers={'X-Tenant': 'alpha'})
+    alpha_engine = engines.get('alpha')
+    assert alpha_engine.pool.checkedin() == 1
+
+    client.get('/panels', headers={'X-Tenant': 'beta'})
+    client.get('/panels', headers={'X-Tenant': 'gamma'})
+
+    assert list(engines._engines) == ['beta', 'gamma']
+    # dispose() swaps the pool, closing the idle connections of the old one
+    assert alpha_engine.pool.checkedin() == 0
@@ -1,6 +1,10 @@
-from datetime import datetime
-from sqlalchemy import and_
-from models import InventoryExtract
+from datetime import datetime, timedelta
+from sqlalchemy import and_, delete, func, select
+from app import db
+from models import Panel, PanelExtract, InventoryExtract, ChangeEvent
+
+# Change events are only needed by clients that are currently connected
+CHANGE_EVENT_RETENTION = timedelta(days=1)
 
 
 def find_replacement_extract(extract_name):
@@ -24,3 +28,43 @@ def find_replacement_extract(extract_name):
     ).order_by(InventoryExtract.expiration_date).first()
     
     return available_extracts
+
+
+def counter_statements():
+    """
+    Build the count queries shown on the homepage, shared with the async API
+    
+    Returns:
+        dict: Counter name mapped to its SELECT COUNT statement
+    """
+    today = datetime.now().date()
+    # Use timedelta instead of day replacement to avoid issues with month boundaries
+    thirty_days_later = today + timedelta(days=30)
+    
+    return {
+        'panel_count': select(func.count(Panel.id)),
+        'active_extracts': select(func.count(PanelExtract.id)).where(PanelExtract.end_date.is_(None)),
+        'inventory_count': select(func.count(InventoryExtract.id)),
+        'soon_expiring': select(func.count(InventoryExtract.id)).where(
+            InventoryExtract.expiration_date >= today,
+            InventoryExtract.expiration_date <= thirty_days_later
+        ),
+    }
+
+
+def record_change(kind, panel_id=None):
+    """
+    Record a panel/inventory change for the server-sent events stream.
+    The event is committed together with the change by the caller; old events
+    are pruned once per request.
+    
+    Args:
+        kind (str): 'panel' or 'inventory'
+        panel_id (int): The panel that changed, if any
+    """
+    if not db.session.info.get('change_events_pruned'):
+        db.session.execute(
+            delete(ChangeEvent).where(ChangeEvent.created_at < datetime.now() - CHANGE_EVENT_RETENTION)
+        )
+        db.session.info['change_events_pruned'] = True
+    db.session.add(ChangeEvent(kind=kind, panel_id=panel_id))